@@ -9,10 +9,14 @@ import sys
 import os
 import argparse
 import time
-import re
+import functools
+import multiprocessing
+import hashlib
+import shelve
 # import logging
 
-from musicxml import MusicXML
+LABEL_CACHE_FILE = '.labelcache'
+MUSICXML_EXTENSION = '.musicxml'
 
 
 def parseargs():
@@ -35,69 +39,124 @@ def parseargs():
     parser.add_argument(
         '-v', "--verbose", action='store_true', default=False,
         help="Activate verbose logging.")
+    parser.add_argument(
+        '-j', '--jobs', type=int, default=os.cpu_count(),
+        help=('Number of worker processes parsing MusicXML files in parallel. '
+              'Verbose logging is only printed with 1 job.'))
+    parser.add_argument(
+        '-c', '--compact', action='store_true', default=False,
+        help=('Rewrite existing labels file fully sorted. By default only new label lines '
+              'are appended to it.'))
+    parser.add_argument(
+        '--cache', action='store_true', default=False,
+        help=(f'Cache generated labels by content hash of input files in {LABEL_CACHE_FILE} '
+              'in output folder. Files with already seen content are not parsed again, '
+              'files unchanged since last run (same mtime and size) are not even hashed.'))
     return parser.parse_args()
 
-# def label_db_list_to_dict(list_: list) -> dict:
-#     """Go through a list of lines, separate the ID at the beginning and return as dictionary.
-    
-#     key:  sequence ID
-#     value: sequence str"""
-#     list_of_tuples = []
-#     for item in list_:
-#         splitted = re.split(r'\s', item)
 
-#     output = {}
-#     for (k, v) in list_:
-#         output[k] = v
-#     return output
+def save_labels(output_file: str, lines: set, compact: bool = False) -> None:
+    """Save label lines (`ID "labels"`) to a file.
+
+    If the file already exists, only lines not yet present are appended to it.
+    With `compact`, existing and new lines are merged and the whole file is rewritten sorted."""
+
+    if not os.path.exists(output_file):
+        write_lines_atomic(output_file, sorted(lines))
+        return
+
+    with open(output_file, 'r', encoding='utf-8', buffering=1 << 20) as f:
+        orig_lines = {line.rstrip('\n') for line in f if line.strip()}
 
+    if compact:
+        lines = lines | orig_lines
+        print(f'Compacting labels file, new total: {len(lines)}')
+        write_lines_atomic(output_file, sorted(lines))
+        return
 
-# def update_labels(orig_labels: list, new_labels: list) -> list:
-#     ...
+    new_lines = sorted(lines - orig_lines)
+    print(f'Appending new {len(new_lines)} label lines to original {len(orig_lines)}, '
+          f'new total: {len(orig_lines) + len(new_lines)}')
+    with open(output_file, 'a', encoding='utf-8', buffering=1 << 20) as f:
+        f.writelines(f'{line}\n' for line in new_lines)
 
 
-def save_labels(output_file: str, labels_db: dict) -> None:
-    """Save labels from dictionary to a file."""
+def write_lines_atomic(output_file: str, lines: list) -> None:
+    """Write lines to a temporary file and move it over output file, so a killed run
+    never leaves a partially written file behind."""
+    tmp_file = f'{output_file}.tmp'
+    with open(tmp_file, 'w', encoding='utf-8', buffering=1 << 20) as f:
+        f.writelines(f'{line}\n' for line in lines)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_file, output_file)
 
-    output_lines = [f'{file} "{labels}"' for file, labels in labels_db]
-    # new_lines_len = len(output_lines)
 
-    # while True:
-    #     if not os.path.exists(output_file):
-    #         break
-    #     split = re.split(r'\.', output_file)
-    #     out_file_name_and_path = '.'.join(split[:-1])
-    #     out_file_ext = split[-1]
-    #     output_file = f'{out_file_name_and_path}_new.{out_file_ext}'
+def process_file(file_name: str, mode: str, verbose: bool = False) -> tuple:
+    """Generate label lines (`filename "sequence"`) for one MusicXML file.
 
-        # with open(output_file, 'r', encoding='utf-8') as f:
-        #     orig_file = f.read()
-        #     orig_lines = re.split('\n', orig_file)
-        #     orig_lines_dict = 
+    Return tuple (input file name, list of label lines)"""
+    # Imported here so argument parsing does not wait for the parser to load
+    from musicxml import MusicXML
 
-        #     # filter out empty lines
-        #     orig_lines = list(filter(None, orig_lines))
+    # Create a MusicXML object for generating sequences
+    musicxml_obj = MusicXML(input_file=file_name, verbose=verbose, mode=mode)
+    # musicxml_obj = MusicXML(input_file=input_path, output_file=output_path)
 
-        # output_lines = sorted(set(output_lines + orig_lines))
-        # print(f'Saving new {new_lines_len} label lines to original {len(orig_lines)}, '
-        #       f'new total: {len(output_lines)}')
+    # Generate output sequence (as list, generator can not be sent back from pool workers)
+    return file_name, list(musicxml_obj.write_label_lines())
 
-    output = '\n'.join(sorted(output_lines)) + '\n'
 
-    with open(output_file, 'w', encoding='utf-8') as f:
-        f.write(output)
+def file_digest(file_name: str) -> str:
+    """Get hash of file content."""
+    digest = hashlib.blake2b(digest_size=16)
+    with open(file_name, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def get_cache_key(cache: shelve.Shelf, file_name: str, mode: str) -> str:
+    """Get cache key of file content. Only files changed since last run (by mtime and size) are hashed."""
+    stat = os.stat(file_name)
+    file_stat = (stat.st_mtime_ns, stat.st_size)
+    stat_key = f'stat:{os.path.abspath(file_name)}'
+
+    cached = cache.get(stat_key)
+    if cached is not None and cached[0] == file_stat:
+        digest = cached[1]
+    else:
+        digest = file_digest(file_name)
+        cache[stat_key] = (file_stat, digest)
+    return f'{mode}:{digest}'
+
+
+def get_file_stem(file_name: str) -> str:
+    """Get file name without folder and extensions, the prefix of all its label IDs."""
+    return os.path.basename(file_name).partition('.')[0]
+
+
+def labels_to_cache(file_name: str, lines: list) -> list:
+    """Strip file name from label lines so files with the same content can share them."""
+    stem_len = len(get_file_stem(file_name))
+    return [line[stem_len:] for line in lines]
+
+
+def labels_from_cache(file_name: str, cached_lines: list) -> list:
+    """Add file name back to cached label lines."""
+    stem = get_file_stem(file_name)
+    return [stem + line for line in cached_lines]
 
 
 def get_files(folder):
     """Get list of existing files in folder with right file extension."""
-    # listdir
-    input_files = os.listdir(folder) if os.path.isdir(folder) else []
+    if not os.path.isdir(folder):
+        return []
 
-    # concat with input folder
-    input_files = [os.path.join(folder, f) for f in input_files]
-
-    # check existing files with correct extension '.musicxml'
-    return [f for f in input_files if os.path.isfile(f) and f.endswith('.musicxml')]
+    # scandir reuses file type from directory listing, no extra stat per file
+    with os.scandir(folder) as entries:
+        return [e.path for e in entries
+                if e.name.endswith(MUSICXML_EXTENSION) and e.is_file(follow_symlinks=False)]
 
 
 def main():
@@ -105,11 +164,11 @@ def main():
 
     start = time.time()
 
-    labels_all = []
+    labels_count = 0
+    labels_seen = set()
     input_files = get_files(args.input_folder)
 
-    if not os.path.exists(args.output_folder):
-        os.makedirs(args.output_folder)
+    os.makedirs(args.output_folder, exist_ok=True)
 
     if args.verbose:
         print(f'Found {len(input_files)} input files, generating labels. ')
@@ -117,30 +176,67 @@ def main():
         print(f'Found {len(input_files)} input files, generating labels. '
               '(every dot is 200 files, every line is 10_000)')
 
+    # Skip files with content already parsed in this or previous runs
+    cache = None
+    files_to_parse = input_files
+    if args.cache:
+        cache = shelve.open(os.path.join(args.output_folder, LABEL_CACHE_FILE))
+        cache_keys = {file_name: get_cache_key(cache, file_name, args.mode) for file_name in input_files}
+        files_to_parse = []
+        keys_to_parse = set()
+        for file_name in input_files:
+            key = cache_keys[file_name]
+            if key not in cache and key not in keys_to_parse:
+                files_to_parse.append(file_name)
+                keys_to_parse.add(key)
+        print(f'Skipping {len(input_files) - len(files_to_parse)} files with already parsed content.')
+
     # Go through all inputs generating output sequences
-    for i, file_name in enumerate(input_files):
+    jobs = max(1, args.jobs or 1)
+    if jobs == 1:
+        worker = functools.partial(process_file, mode=args.mode, verbose=args.verbose)
+        results = map(worker, files_to_parse)
+        pool = None
+    else:
+        # Workers are not verbose, their logs would interleave on stdout
+        worker = functools.partial(process_file, mode=args.mode)
+        pool = multiprocessing.Pool(jobs)
+        results = pool.imap_unordered(worker, files_to_parse, chunksize=32)
+
+    for i, (file_name, file_labels) in enumerate(results):
         if not args.verbose and i % 200 == 0 and i > 0:
+            # No explicit flush, dots are written out with the end of each line
             print('.', end='')
             if i % 10_000 == 0:
                 print('')
-            sys.stdout.flush()
-        # Create a MusicXML object for generating sequences
-        musicxml_obj = MusicXML(input_file=file_name, verbose=args.verbose, mode=args.mode)
-        # musicxml_obj = MusicXML(input_file=input_path, output_file=output_path)
-
-        # Generate output sequence
-        labels_all += musicxml_obj.write_sequences()
+        labels_count += len(file_labels)
+        labels_seen.update(file_labels)
+        if cache is not None:
+            cache[cache_keys[file_name]] = labels_to_cache(file_name, file_labels)
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    if cache is not None:
+        parsed_files = set(files_to_parse)
+        for file_name in input_files:
+            if file_name not in parsed_files:
+                file_labels = labels_from_cache(file_name, cache[cache_keys[file_name]])
+                labels_count += len(file_labels)
+                labels_seen.update(file_labels)
+        cache.close()
 
     print('')
     print('--------------------------------------')
     db_file_name = '0_labels.semantic'
     db_file_name_path = os.path.join(args.output_folder, db_file_name)
-    save_labels(db_file_name_path, labels_all)
+    save_labels(db_file_name_path, labels_seen, compact=args.compact)
     print('Results:')
     print(f'From {len(input_files)} input files')
-    print(f'\tgot {len(labels_all)} label lines')
-    # for file, labels in labels_all:
-    #     print(labels)
+    print(f'\tgot {labels_count} label lines')
+    # for line in labels_seen:
+    #     print(line)
 
     end = time.time()
     print(f'Total time: {end - start:.2f} s')
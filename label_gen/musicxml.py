@@ -11,17 +11,68 @@ MuseScore 4 (my new purposed pipeline)
 TODO implement MuseScore4 purposed pipeline
 """
 
-# import sys
+import sys
+import array
 import functools
+import heapq
 import os
 import re
 import logging
 from enum import Enum
 
-import xml.etree.ElementTree as ET
+from lxml import etree as ET
 
 from measure import Measure
 
+# Separator tokens of voice lines, interned so voice merging can compare them by identity
+TOK_PLUS = sys.intern('+ ')
+TOK_BARLINE = sys.intern('barline ')
+TOK_BAR = sys.intern('+ barline ')
+TOK_FWD = sys.intern('forward')
+
+# Attributes of <print> element starting a new system (or page)
+NEW_SYSTEM_ATTRIBS = frozenset(('new-page', 'new-system'))
+
+# Whole words of a sequence containing key, clef or time signature
+SIGNATURE_WORD_RE = re.compile(r'\S*(?:key|clef|time)\S*')
+
+# Number of each note name for the purpose of sorting chords
+NOTE_NUMS = {
+    'Cb': 0,
+    'C': 1,
+    'C#': 2,
+    'Db': 2,
+    'D': 3,
+    'D#': 4,
+    'Eb': 4,
+    'E': 5,
+    'E#': 6,
+    'Fb': 6,
+    'F': 7,
+    'F#': 8,
+    'Gb': 8,
+    'G': 9,
+    'G#': 10,
+    'Ab': 10,
+    'A': 11,
+    'A#': 12,
+    'Bb': 12,
+    'B': 13,
+    'B#': 14,
+}
+
+
+@functools.lru_cache(maxsize=None)
+def note_to_num(note):
+    """Converts note to num for purpose of sorting"""
+    num = NOTE_NUMS.get(note)
+    if num is None:
+        num = NOTE_NUMS.get(note[:-1])
+        if num is None:
+            print('Error with note dict?', note)
+            return 0
+    return num
+
 
 class ParsingMode(Enum):
     """Set options for parsing modes. (see genlabels argparse help)"""
@@ -29,6 +80,54 @@ class ParsingMode(Enum):
     NEW_SYSTEM = 2
 
 
+class Utf8Reader:
+    """Binary reader over a text file. lxml iterparse only reads bytes, this keeps reading
+    the file as text the same way ET.parse does (ignoring decoding errors)."""
+
+    def __init__(self, text_file):
+        self.text_file = text_file
+
+    def read(self, size: int = -1) -> bytes:
+        return self.text_file.read(size).encode('utf-8')
+
+
+class MeasureState:
+    """Tracking variables of one measure shared by element handlers of MusicXML.read_measure."""
+
+    __slots__ = ('num_staves', 'cur_staves', 'staves', 'skip', 'skip_measure', 'voice_lines',
+                 'voice_durations', 'voice_totals', 'forward_dur', 'cur_voice', 'is_chord',
+                 'is_grace', 'prev_grace')
+
+    def __init__(self, num_staves: int, cur_staves: list):
+        self.num_staves = num_staves
+        self.cur_staves = cur_staves    # Sequence of previous measures
+        self.staves = ['' for _ in range(num_staves)]
+        self.skip = 0                   # Number of measures to skip for multirest
+        self.skip_measure = False       # Percussion/guitar tab measure, not labeled
+        self.voice_lines = dict()       # Symbolic representations of each voice
+        self.voice_durations = dict()   # Length (in time) of each symbol of each voice
+        self.voice_totals = dict()      # Sum of durations of each voice
+        self.forward_dur = []           # used for weird use of a 2nd voice
+        self.cur_voice = -1             # tracks current voice
+        self.is_chord = False           # Used for determining to advance (+ symbol)
+
+        # Grace note tracking
+        self.is_grace = False
+        self.prev_grace = False
+
+    def add_voice(self, voice):
+        """Start an empty symbolic representation of a new voice."""
+        self.voice_lines[voice] = []
+        self.voice_durations[voice] = array.array('q')
+        self.voice_totals[voice] = 0
+
+    def add_symbol(self, voice, symbol, duration=0):
+        """Append symbol with its duration to a voice, keeping the total duration of the voice."""
+        self.voice_lines[voice].append(symbol)
+        self.voice_durations[voice].append(duration)
+        self.voice_totals[voice] += duration
+
+
 class MusicXML():
     """
     Class that converts MusicXML to a sequence by parsing it.
@@ -40,10 +139,27 @@ class MusicXML():
     OUTPUT_MODE_STR = 'output_mode_str'
     OUTPUT_MODE_FILE = 'output_mode_file'
 
+    __slots__ = ('input_file', 'output_file', 'output_mode', 'mode', 'key', 'clef', 'time',
+                 'beat', 'beat_type', 'polyphonic_page', 'musescore_version', 'root', 'width',
+                 'width_cutoff', '_extract', '_tag_handlers', '_part_list', '_first_part',
+                 '_note_sort_keys')
+
     def __init__(self, input_file=None, output_file=None, verbose: bool=False, mode: str = 'new-system'):
         """
         Stores MusicXML file passed in 
         """
+        # Parsed note symbols used for sorting chords (see note_sort_key)
+        self._note_sort_keys = dict()
+
+        # Handlers of measure child elements used in read_measure
+        self._tag_handlers = {
+            'attributes': self.read_attributes,
+            'note': self.read_note,
+            'direction': self.read_direction,
+            'forward': self.read_forward,
+            'backup': self.read_backup,
+        }
+
         # self.verbose = verbose
         if verbose:
             logging.basicConfig(level=logging.DEBUG, format='[%(levelname)-s]\t- %(message)s')
@@ -58,6 +174,12 @@ class MusicXML():
         else:
             self.mode = ParsingMode.NEW_SYSTEM
 
+        # Sequence extractor of the chosen mode used in write_sequences
+        if self.mode is ParsingMode.ORIG:
+            self._extract = self.get_sequences_orig
+        else:
+            self._extract = self.get_sequences_new_system
+
         if not output_file:
             self.output_mode = self.OUTPUT_MODE_STR
             self.output_file = input_file
@@ -82,26 +204,49 @@ class MusicXML():
         self.musescore_version = self.UNSET_MUSESCORE_VERSION
 
         # Read file
+        self._part_list = None
+        self._first_part = None
         self.root = self.get_root()
         if self.root is None:
             return
 
+        # Find <part-list> and <part> elements once (1st part only is used to generate sequence)
+        self._part_list = self.root.find('part-list')
+        self._first_part = self.root.find('part')
+
         # Get musescore version from read file.
         self.musescore_version = self.get_musescore_version()
 
         # Read the width and cutoffs for each page of the .musicxml file
-        if self.mode == ParsingMode.ORIG:
+        if self.mode is ParsingMode.ORIG:
             self.get_width()
-        elif self.mode == ParsingMode.NEW_SYSTEM:
+        elif self.mode is ParsingMode.NEW_SYSTEM:
             self.width_cutoff = self.UNSET_WIDTH
 
     def get_root(self):
-        """Read file and parse it as XML. Return None if file is invalid."""
+        """
+        Read header of the file (everything before the first <part>) and parse it as XML.
+        Measures are not parsed here, they are streamed by iter_part_measures.
+        Return None if file is invalid.
+        """
         with open(self.input_file, 'r', errors='ignore', encoding='utf-8') as input_file:
+            context = ET.iterparse(Utf8Reader(input_file), events=('start', 'end'),
+                                   tag=('software', 'part', 'measure'), remove_comments=True, remove_pis=True)
             # Check for valid parse tree in .musicxml file
             try:
-                tree = ET.parse(input_file)
-                return tree.getroot()
+                software_found = False
+                for event, elem in context:
+                    if elem.tag == 'software':
+                        software_found = True
+                    elif elem.tag == 'part':
+                        if event == 'start' and software_found:
+                            # Header is read, stop at the start of the first part
+                            return elem.getroottree().getroot()
+                    elif event == 'end':
+                        # Still looking for software tag, measures are not needed
+                        self.clear_measure(elem)
+                # No part (or no software tag before it), whole file read
+                return context.root
             except ET.ParseError:
                 print('Invalid XML file')
                 return None
@@ -126,62 +271,46 @@ class MusicXML():
 
         margins = 0
 
-        # Index in parse tree with information about page width
-        defaults_idx = -1
-
         # Look for "defaults" tag which contains page width information
-        for i, child in enumerate(self.root):
-            if child.tag == 'defaults' or child.tag == 'part-list':
-                defaults_idx = i
-                break
+        page_layout = self.root.find('defaults/page-layout')
 
         # Check for bad MusicXML
-        if defaults_idx == -1:
+        if self.root.find('defaults') is None and self._part_list is None:
             print('MusicXML file:', self.input_file,' missing <score-partwise> or <part>')
             return
 
-        # .MusicXML defines margins separately for odd even pages,
-        #  assume they are the same
-        margin_found = False            
+        if page_layout is not None:
+            page_width = page_layout.find('page-width')
+            if page_width is not None:
+                self.width = float(page_width.text)
 
-        # Get number of staves in the MusicXML
-        for i,e in enumerate(self.root[defaults_idx]):
-            if e.tag == 'page-layout':
-                for c in e:
-                    if c.tag == 'page-width':
-                        self.width = float(c.text)
-                    elif c.tag == 'page-margins' and not margin_found:
-                        for k in c:
-                            if k.tag == 'left-margin':
-                                margins += float(k.text)
-                            elif k.tag == 'right-margin':
-                                margins += float(k.text)
-                        margin_found = True
+            # .MusicXML defines margins separately for odd even pages,
+            #  assume they are the same
+            page_margins = page_layout.find('page-margins')
+            if page_margins is not None:
+                for k in page_margins.iterchildren('left-margin', 'right-margin'):
+                    margins += float(k.text)
 
         # Based on width and margins read, set the width per page, for calculating
         # when to proceed to next page (sample) while generating labels
         self.width_cutoff = self.width - margins + 1               
 
-    def write_sequences(self) -> list:
+    def write_sequences(self):
         """
         Convert MusicXML sequence into semantic encodings
         Outputs the sequences of this MusicXML object
         to the output file (one page = one sequence) or returns as a string.
 
-        Return list of tuples (filename, sequence)
+        Yield tuples (filename, sequence)
         """
         # Read all of the sequences of a .musicxml, each page counts as one
-        if self.mode == ParsingMode.ORIG:
-            sequences = self.get_sequences_orig()
-        elif self.mode == ParsingMode.NEW_SYSTEM:
-            sequences = self.get_sequences_new_system()
-        elif self.musescore_version == self.UNSET_MUSESCORE_VERSION:
-            return
+        sequences = self._extract()
 
         # fname = self.output_file.split('.')[0]
         logging.debug(f'\tSeparated into {len(sequences)} files.')
 
-        labels_out = []
+        # Name of output files without folder and extensions (same for all pages)
+        file_stem = os.path.basename(self.output_file).partition('.')[0]
 
         # Write all of the ground truth sequences to files
         for file_num, seq in enumerate(sequences):
@@ -198,24 +327,29 @@ class MusicXML():
 
             # Write the sequence to appropriately named file
             # with open(fname + '-' + str(file_num) + '.semantic', 'w') as out_file:
-            output_file = re.split(r'\.', os.path.basename(self.output_file))[0]
+            output_file = file_stem
 
             if self.musescore_version == 3:
-                output_file = f'{output_file}_s{str(file_num + 1).zfill(3)}'
+                output_file = f'{file_stem}_s{file_num + 1:03}'
                 output_file_path = f'{output_file}.semantic'
             elif self.musescore_version == 4:
-                output_file = f'{output_file}_s{file_num:03}'
+                output_file = f'{file_stem}_s{file_num:03}'
                 output_file_path = f'{output_file}.semantic'
 
             if self.output_mode == self.OUTPUT_MODE_FILE:
                 with open(output_file, 'w', encoding='utf-8') as out_file:
-                    out_file.write('')
-                    out_file.write((seq + '\n'))
-                    out_file.write('')
-                    out_file.close()
+                    out_file.write(seq)
+                    out_file.write('\n')
 
-            labels_out.append((output_file, seq))
-        return labels_out
+            yield output_file, seq
+
+    def write_label_lines(self):
+        """
+        Same as write_sequences, but yield sequences already formatted as label lines:
+        `filename "sequence"`
+        """
+        for output_file, seq in self.write_sequences():
+            yield f'{output_file} "{seq}"'
 
     def get_sequences_new_system(self):
 
@@ -234,44 +368,37 @@ class MusicXML():
 
         new_score = True
 
-        # Indexing for part list
-        part_list_idx = -1
-        part_idx = -1
-
-        # Find <part-list> and <part> element indexes
-        for i, child in enumerate(self.root):
-            if child.tag == 'part-list':
-                part_list_idx = i
-            elif child.tag == 'part':
-                # Choose 1st part only to generate sequence
-                part_idx = i if part_idx == -1 else part_idx
+        # Find <part-list> and <part> elements (choose 1st part only to generate sequence)
+        part_list = self._part_list
+        part = self._first_part
 
         # Check for bad MusicXML
-        if part_list_idx == -1 or part_idx == -1:
+        if part_list is None or part is None:
             print('MusicXML file:', self.input_file,' missing <part-list> or <part>')
             return ['']
 
-        # Get number of staves in the MusicXML
-        num_staves = 1
-        try:
-            for e in self.root[part_idx][0][0]:
-                if e.tag == 'staff-layout':
-                    num_staves = int(e.attrib['number'])
-        except IndexError:
-            return ['']
-        staves = ['' for x in range(num_staves)]    # Holds sequence of each staff
-
-        # Read each measure
-        r_iter = iter(self.root[part_idx])
+        # Read each measure (streamed, not kept in memory after reading)
+        r_iter = self.iter_part_measures()
         # cur_width = 0.0     # Sum of width of measures currently read
         page_num = 1        # Current page number (for naming)
         # new_page_m3 = False    # Tracks if just beginning a new page due to "print" element
         new_system_m4 = False  # Tracks if just beginning a new system OR PAGE
 
-        last_part_number = self.get_last_part_number(part_idx)
+        # Get number of staves in the MusicXML
+        num_staves = 1
+        staves = None
 
         # Iterate through all measures
-        for i, measure in enumerate(r_iter):
+        for measure, is_last_measure in r_iter:
+            if staves is None:
+                try:
+                    for e in measure[0]:
+                        if e.tag == 'staff-layout':
+                            num_staves = int(e.attrib['number'])
+                except IndexError:
+                    return ['']
+                staves = [[] for x in range(num_staves)]    # Holds sequence fragments of each staff
+
             # Increment current width by the measure's width
             # cur_width += float(measure.attrib['width'])
 
@@ -300,14 +427,14 @@ class MusicXML():
 
             if new_system_m4:
                 # Save the current sequence to be saved
-                sequences.append(staves[0])
-                staves = ['' for x in range(num_staves)]
+                sequences.append(''.join(staves[0]))
+                staves = [[] for x in range(num_staves)]
                 # cur_width = int(float(measure.attrib['width']))
                 page_num += 1
 
                 # Reset polyphonic page and print if necessary
                 if self.polyphonic_page:
-                    file_name = re.split('\.', os.path.basename(self.input_file))[0]
+                    file_name = os.path.basename(self.input_file).partition('.')[0]
                     poly_page_file = f'{file_name}-{page_num-1}'
                     logging.debug(f'\tpolyphonic page: {poly_page_file}')
                 self.polyphonic_page = False
@@ -318,11 +445,13 @@ class MusicXML():
             new_score = False
 
             # Updates current symbolic sequence of each staff with current measure's symbols
+            # (only non-empty fragments, empty list means empty staff)
             for j in range(num_staves):
-                staves[j] += measure_staves[j]
+                if measure_staves[j]:
+                    staves[j].append(measure_staves[j])
 
-            if measure.attrib['number'] == last_part_number:
-                sequences.append(staves[0])
+            if is_last_measure:
+                sequences.append(''.join(staves[0]))
 
             # print(f'len(sequences): {len(sequences)}')
 
@@ -338,23 +467,59 @@ class MusicXML():
         #     staves = ['' for x in range(num_staves)]
         #     cur_width = int(float(measure.attrib['width']))
 
+        # Invalid XML found while streaming measures
+        if self.root is None:
+            return []
+
         return sequences
 
-    def get_last_part_number(self, part_id: int):
-        """Get number of the last part in the score."""
-        last_meassure = self.root[part_id][-1]
-        # measure_number = measure.attrib['number']
-        return last_meassure.attrib['number']
+    def iter_part_measures(self):
+        """
+        Stream measures of the first part of the score using iterparse.
+        Yield tuples (measure, is_last_measure). Measures are cleared after being read.
+        Rest of the file is only checked to be valid XML, if it is not, self.root is set to None.
+        """
+        with open(self.input_file, 'r', errors='ignore', encoding='utf-8') as input_file:
+            context = ET.iterparse(Utf8Reader(input_file), events=('end',), tag='measure',
+                                   remove_comments=True, remove_pis=True)
+            part = None
+            previous = None
+            try:
+                for _, measure in context:
+                    if part is None:
+                        part = measure.getparent()
+                    elif measure.getparent() is not part:
+                        break
+
+                    # Previous measure is yielded only now, to know whether it is the last one
+                    if previous is not None:
+                        yield previous, False
+                        self.clear_measure(previous)
+                    previous = measure
+
+                if previous is not None:
+                    yield previous, True
+
+                # Parse rest of the file to find invalid XML (same as when parsing whole file)
+                for _, measure in context:
+                    self.clear_measure(measure)
+            except ET.ParseError:
+                print('Invalid XML file')
+                self.root = None
+
+    @staticmethod
+    def clear_measure(measure):
+        """Free already read measure and all measures before it."""
+        measure.clear()
+        parent = measure.getparent()
+        while measure.getprevious() is not None:
+            del parent[0]
 
     def is_new_measure_system(self, measure):
         """Check if meassure contatins "new-system" or "new-page" tag."""
-        # Check if need to create a new page (ie. new sample)
-        child_elems = [e for e in measure]
-
-        # Get MuseScore4 new_system marker
-        for elem in child_elems:
-            if (elem.tag == 'print' and
-                    ('new-page' in elem.attrib or 'new-system' in elem.attrib)):
+        # Get MuseScore4 new_system marker (only <print> children are visited)
+        for elem in measure.iterchildren('print'):
+            if not NEW_SYSTEM_ATTRIBS.isdisjoint(elem.attrib):
                 # print(ET.tostring(measure).decode()[:100])
                 return True
         return False
@@ -380,67 +545,50 @@ class MusicXML():
 
         new_score = True
 
-        # Indexing for part list
-        part_list_idx = -1
-        part_idx = -1
-
-        # Find <part-list> and <part> element indexes
-        for i, child in enumerate(self.root):
-            if child.tag == 'part-list':
-                part_list_idx = i
-            elif child.tag == 'part':
-                # Choose 1st part only to generate sequence
-                part_idx = i if part_idx == -1 else part_idx
+        # Find <part-list> and <part> elements (choose 1st part only to generate sequence)
+        part_list = self._part_list
+        part = self._first_part
 
         # Check for bad MusicXML
-        if part_list_idx == -1 or part_idx == -1:
+        if part_list is None or part is None:
             print('MusicXML file:', self.input_file,' missing <part-list> or <part>')
             return ['']
 
-        # Get number of staves in the MusicXML
-        num_staves = 1
-        try:
-            for e in self.root[part_idx][0][0]:
-                if e.tag == 'staff-layout':
-                    num_staves = int(e.attrib['number'])
-        except IndexError:
-            return ['']
-        staves = ['' for x in range(num_staves)]    # Holds sequence of each staff
-
-        # Read each measure
-        r_iter = iter(self.root[part_idx])
+        # Read each measure (streamed, not kept in memory after reading)
+        r_iter = self.iter_part_measures()
         cur_width = 0.0     # Sum of width of measures currently read
         page_num = 1        # Current page number (for naming)
         new_page_m3 = False    # Tracks if just beginning a new page due to "print" element
         # new_system_m4 = False  # Tracks if just beginning a new system OR PAGE
 
+        # Get number of staves in the MusicXML
+        num_staves = 1
+        staves = None
+
         # Iterate through all measures
-        for i, measure in enumerate(r_iter):
+        for measure, _ in r_iter:
+            if staves is None:
+                try:
+                    for e in measure[0]:
+                        if e.tag == 'staff-layout':
+                            num_staves = int(e.attrib['number'])
+                except IndexError:
+                    return ['']
+                staves = [[] for x in range(num_staves)]    # Holds sequence fragments of each staff
 
             # Increment current width by the measure's width
             cur_width += float(measure.attrib['width'])
 
             # Check if need to create a new page (ie. new sample)
-            child_elems = [e for e in measure]
-            child_tags = [e.tag for e in child_elems]
-
-            # # Get MuseScore4 new_system marker
-            # for elem in child_elems:
-            #     if (elem.tag == 'print' and
-            #             ('new-page' in elem.attrib or 'new-system' in elem.attrib)):
-            #         new_system_m4 = True
-            #         break
-
-            # Get MuseScore3 new_page marker
-            if 'print' in child_tags:
-                print_children = [e.tag for e in list(iter(child_elems[child_tags.index('print')]))]
-                if 'system-layout' in print_children:
-                    new_page_m3 = True
+            # Get MuseScore3 new_page marker (system-layout in first <print>)
+            print_elem = measure.find('print')
+            if print_elem is not None and print_elem.find('system-layout') is not None:
+                new_page_m3 = True
 
             if cur_width > self.width_cutoff or new_page_m3:
                 # Save the current sequence to be saved
-                sequences.append(staves[0])
-                staves = ['' for x in range(num_staves)]
+                sequences.append(''.join(staves[0]))
+                staves = [[] for x in range(num_staves)]
                 cur_width = int(float(measure.attrib['width']))
                 page_num += 1
 
@@ -454,8 +602,10 @@ class MusicXML():
             new_score = False
 
             # Updates current symbolic sequence of each staff with current measure's symbols
+            # (only non-empty fragments, empty list means empty staff)
             for j in range(num_staves):
-                staves[j] += measure_staves[j]
+                if measure_staves[j]:
+                    staves[j].append(measure_staves[j])
 
             # Skips any measures as needed
             for j in range(skip-1):
@@ -463,10 +613,14 @@ class MusicXML():
 
             new_page_m3 = False
 
+        # Invalid XML found while streaming measures
+        if self.root is None:
+            return []
+
         # Add any remaining measures to list of sequences
         if cur_width > 0:
-            sequences.append(staves[0])
-            staves = ['' for x in range(num_staves)]
+            sequences.append(''.join(staves[0]))
+            staves = [[] for x in range(num_staves)]
             cur_width = int(float(measure.attrib['width']))
 
         return sequences
@@ -481,6 +635,7 @@ class MusicXML():
         num_staves: number of staves in the measure
         new_page: indiciates if starting a new page
         cur_staves: rest of sequence so far from previous measures
+                    (string or list of fragments, only tested for emptiness)
         new_score: indicates if first measure of the score
         """
 
@@ -488,13 +643,12 @@ class MusicXML():
         m = Measure(measure, num_staves, self.beat, self.beat_type)
 
         # Tracking variables for the current sequence of each staff/voices for polyphonic music
-        staves = ['' for _ in range(num_staves)]
-        skip = 0
-        voice_lines = dict()        # Symbolic representations of each voice
-        voice_durations = dict()    # Length (in time) of each symbol of each voice
-
-        forward_dur = []    # used for weird use of a 2nd voice
-        cur_voice = -1      # tracks current voice
+        state = MeasureState(num_staves, cur_staves)
+        staves = state.staves
+        voice_lines = state.voice_lines
+        voice_durations = state.voice_durations
+        voice_totals = state.voice_totals
+        forward_dur = state.forward_dur
 
         # Track the clef, key, time signature that each sequence should start with
         start_clef = self.clef
@@ -505,131 +659,54 @@ class MusicXML():
         if 'percussion' in self.clef or 'TAB' in self.clef:
             return staves, 0
 
-        # Grace note tracking
-        is_grace = False
-        prev_grace = False
-
         # Iterate through all elements in measure
         for elem in measure:
 
             # Stores symbolic sequence representing the current element being read
             cur_elem = ['' for _ in range(num_staves)]
 
-            is_chord = False    # Used for determining to advance (+ symbol)
-
-            if elem.tag == 'attributes':
+            state.is_chord = False    # Used for determining to advance (+ symbol)
 
-                # Parse the attributes element
-                # (Skip is number of measures to skip for multirest)
-                cur_elem,skip,self.beat,self.beat_type = m.parse_attributes(elem)
+            handler = self._tag_handlers.get(elem.tag)
+            if handler is not None:
+                cur_elem = handler(elem, m, state)
 
                 # Skip percussion/guitar music
-                if 'percussion' in cur_elem[0] or 'TAB' in cur_elem[0] or \
-                    'percussion' in cur_elem or 'TAB' in cur_elem:
-                    self.clef = 'percussion'
+                if state.skip_measure:
                     return ['' for _ in range(num_staves)], 0
 
-            elif elem.tag == 'note':
-
-                # Parse note element and get the symbolic representation of it
-                cur_elem,is_chord,voice,duration,is_grace,_ = m.parse_note(elem)
-
-                # Check if new voice started
-                if cur_voice != voice and cur_voice != -1:
-
-                    # Add any remaining forwards to previous voice
-                    if len(forward_dur) != 0 and cur_voice in voice_lines:
-                        voice_lines[cur_voice].append('forward')
-                        voice_durations[cur_voice].append(forward_dur[-1])
-                        del forward_dur[-1]
-
-                cur_voice = voice
-
-                # Skip multi staff notes
-                if cur_elem == 'multi-staff':
+                # Skip element (multi staff notes)
+                if cur_elem is None:
                     continue
 
-                # No print object case, include a duration, but don't generate symbol
-                if cur_elem == 'forward':
-
-                    if len(forward_dur) == 1:
-                        forward_dur[0] += duration
-                    else:
-                        forward_dur.append(duration)
-
-                else:
-
-                    # Update voicing stuff (for multi voice aka polyphony)
-                    if voice not in voice_lines:
-                        voice_lines[voice] = []
-                        voice_durations[voice] = []
-                        if len(forward_dur) != 0:       # Handle weird case when voice added in middle of a measure
-                            voice_lines[voice].append('+ ')
-                            voice_lines[voice].append('forward')
-                            voice_durations[voice].append(0)
-                            voice_durations[voice].append(forward_dur[-1])
-                            del forward_dur[-1]
-                    
-                    # If not a chord, append a '+' and 0 duration for it
-                    if ((cur_staves[0] != '' or staves[0] != '') and not is_chord and cur_elem[0] != '') and not is_grace and not prev_grace:
-                        voice_lines[voice].append('+ ')
-                        voice_durations[voice].append(0)
-                        voice_lines[voice].append(cur_elem[0])
-                        voice_durations[voice].append(duration)
-                    else:
-                        # Different behavior if first note of sequence
-                        if staves[0] != '':
-                            voice_lines[voice].append(cur_elem[0])
-                            voice_durations[voice].append(0)
-                        else:
-                            voice_lines[voice].append('+ ')
-                            voice_durations[voice].append(0)
-                            voice_lines[voice].append(cur_elem[0])
-                            voice_durations[voice].append(duration)
-                        
-            elif elem.tag == 'direction':       # Parse direction element (not used)
-                cur_elem = m.parse_direction(elem)
-
-            elif elem.tag == 'forward':         # Parse forward element (used for multi voice music)
-                forward_dur.append(int(elem[0].text))
-
-            elif elem.tag == 'backup':          # Switching voice indication
-
-                # Add any remaining forwards to previous voice
-                if len(forward_dur) != 0 and cur_voice in voice_lines:
-                    voice_lines[cur_voice].append('forward')
-                    voice_durations[cur_voice].append(forward_dur[-1])
-                    del forward_dur[-1]
-
-                if len(forward_dur) != 0:
-                    forward_dur = []
-
-                cur_voice = -1
+            is_chord = state.is_chord
 
             # Add whatever was read to the staves
             for i in range(num_staves):
                 if 'multirest' in cur_elem[0]:
                     pass
-                if cur_elem != 'forward':
-                    if (cur_staves[i] != '' or staves[i] != '') and not is_chord and cur_elem[i] != '':
-                        staves[i] += '+ ' + cur_elem[i]
+                if cur_elem != TOK_FWD:
+                    if (cur_staves[i] or staves[i] != '') and not is_chord and cur_elem[i] != '':
+                        staves[i] += TOK_PLUS + cur_elem[i]
                     else:
                         staves[i] += cur_elem[i] 
 
+            # Signature inside of a sequence is a new symbol, not part of a chord
+            new_symbol = (cur_staves[0] or staves[0] != '') and not is_chord and cur_elem[0] != ''
+
             # Store current key/time/clef signature if found
-            for word in cur_elem[0].split():
+            # (only words containing any of them are matched, others are skipped by the regex)
+            for word_match in SIGNATURE_WORD_RE.finditer(cur_elem[0]):
+                word = word_match.group(0)
 
                 # Check for key
                 if 'key' in word:
                     
                     # If not a chord, append a '+' and 0 duration for it
-                    if ((cur_staves[0] != '' or staves[0] != '') and not is_chord and cur_elem[0] != '') \
-                        and self.key != '':
+                    if new_symbol and self.key != '':
                         for v in voice_lines.keys():
-                            voice_durations[v].append(0)
-                            voice_durations[v].append(0)
-                            voice_lines[v].append('+ ')
-                            voice_lines[v].append(word + ' ')
+                            state.add_symbol(v, TOK_PLUS)
+                            state.add_symbol(v, word + ' ')
                             
                     self.key = word
                     start_key = self.key
@@ -638,13 +715,10 @@ class MusicXML():
                 if 'clef' in word:
                     
                     # If not a chord, append a '+' and 0 duration for it
-                    if ((cur_staves[0] != '' or staves[0] != '') and not is_chord and cur_elem[0] != '') \
-                        and self.clef != '':
+                    if new_symbol and self.clef != '':
                         for v in voice_lines.keys():
-                            voice_durations[v].append(0)
-                            voice_durations[v].append(0)
-                            voice_lines[v].append('+ ')
-                            voice_lines[v].append(word + ' ')
+                            state.add_symbol(v, TOK_PLUS)
+                            state.add_symbol(v, word + ' ')
      
                     self.clef = word
                     start_clef = self.clef
@@ -653,46 +727,43 @@ class MusicXML():
                 if 'time' in word:
                     
                     # If not a chord, append a '+' and 0 duration for it
-                    if ((cur_staves[0] != '' or staves[0] != '') and not is_chord and cur_elem[0] != '') \
-                        and self.time != '':
+                    if new_symbol and self.time != '':
                         for v in voice_lines.keys():
-                            voice_durations[v].append(0)
-                            voice_durations[v].append(0)
-                            voice_lines[v].append('+ ')
-                            voice_lines[v].append(word + ' ')
+                            state.add_symbol(v, TOK_PLUS)
+                            state.add_symbol(v, word + ' ')
         
                     self.time = word
                     start_time = self.time
 
             # Skip rest of measure if multirest
-            if skip > 0:
+            if state.skip > 0:
                 break
 
             # Update grace note tracking
-            prev_grace = is_grace
+            state.prev_grace = state.is_grace
+
+        # Voices of the measure are complete, sort them once
+        sorted_keys = sorted(voice_lines)
 
         # Add measure separator to just one voice
         if len(voice_lines) > 0:
-            key = sorted(voice_lines.keys())[0]
-            voice_lines[key].append('+ ')
-            voice_lines[key].append('barline ')
-            voice_durations[key].append(0)
-            voice_durations[key].append(0)
+            first_key = sorted_keys[0]
+            state.add_symbol(first_key, TOK_PLUS)
+            state.add_symbol(first_key, TOK_BARLINE)
 
         # Add any remaining forwards to last voice if not extra
         if len(forward_dur) != 0 and len(voice_lines) > 0:
-            keys = sorted(voice_lines.keys())
-            max_sum = sum(voice_durations[keys[0]])
+            keys = sorted_keys
+            max_sum = voice_totals[keys[0]]
 
             # Only add if not an extra forward for diff staff possibly
-            if (sum(voice_durations[keys[-1]]) + forward_dur[-1]) <= max_sum:
-                voice_lines[keys[-1]].append('forward')
-                voice_durations[keys[-1]].append(forward_dur[-1])
+            if (voice_totals[keys[-1]] + forward_dur[-1]) <= max_sum:
+                state.add_symbol(keys[-1], TOK_FWD, forward_dur[-1])
                 del forward_dur[-1]
 
         # Add measure separator to each staff
         for i in range(num_staves):
-            staves[i] = staves[i] + '+ barline '
+            staves[i] = staves[i] + TOK_BAR
 
         # Rearrange measure notes order based on voice durations for multivoice music
         if len(voice_lines) > 1:
@@ -701,70 +772,21 @@ class MusicXML():
             self.polyphonic_page = True
 
             # Add durations incase problem with one of the voices
-            keys = sorted(voice_lines.keys())
-            max_sum = max([sum(voice_durations[k]) for k in keys])
+            keys = sorted_keys
+            total = max(voice_totals.values())
             for k in keys:
-                if sum(voice_durations[k]) < max_sum:
-                    voice_lines[k].append('')
-                    voice_durations[k].append(max_sum - sum(voice_durations[k]))
+                if voice_totals[k] < total:
+                    state.add_symbol(k, '', total - voice_totals[k])
 
             # Initialize values before combining voices in label
             staves[0] = ''
-            min_sum = 0
-            total = 0
-            voice_idxs = dict()
-            voice_sums = dict()
-            for voice in voice_lines:
-                voice_idxs[voice] = 0
-                voice_sums[voice] = 0
-                total = max(total, sum(voice_durations[voice]))
-            notes_to_add = []
-
-            c = 0   # Counter for infinite loop corner case
-            while min_sum < total:
-                
-                # Break out of loop if necessary
-                c += 1          
-                if c >= 100:
-                    print('Loop broken')
-                    return ['' for x in range(num_staves)], 0
-                    
-                # Track the sum of durations of each voice for ordering purposes in labeling 
-                cur_sums = []
-                for voice in voice_lines:
-                    cur_sums.append(voice_sums[voice])
-                min_sum = min(cur_sums)
-
-                for voice in voice_lines:
-
-                    # Add all sums that are equal to min to current timestep 
-                    if voice_sums[voice] == min_sum and voice_idxs[voice] < len(voice_lines[voice]):
+            notes_to_add = self.merge_voices(voice_lines, voice_durations, total)
+            if notes_to_add is None:
+                print('Loop broken')
+                return ['' for x in range(num_staves)], 0
 
-                        if (len(notes_to_add) == 0 or (notes_to_add[-1] != '+ ' or voice_lines[voice][voice_idxs[voice]] != '+ ')) \
-                            and voice_lines[voice][voice_idxs[voice]] != 'forward':
-                            notes_to_add.append(voice_lines[voice][voice_idxs[voice]])
-                        
-                        # Update current voice
-                        voice_sums[voice] += voice_durations[voice][voice_idxs[voice]]
-                        voice_idxs[voice] += 1
-                        
-                        # Add the rest of chord if relevant (keep adding till + encountered)
-                        while voice_idxs[voice] < len(voice_lines[voice]) and \
-                              ((voice_lines[voice][voice_idxs[voice]] != '+ ' and \
-                              notes_to_add[-1] != '+ ') or \
-                              voice_lines[voice][voice_idxs[voice]] == 'barline '):
-                              
-                            # Only add if not a 'forward'
-                            if voice_lines[voice][voice_idxs[voice]] != 'forward':
-                                notes_to_add.append(voice_lines[voice][voice_idxs[voice]])
-
-                            voice_sums[voice] += voice_durations[voice][voice_idxs[voice]]
-                            voice_idxs[voice] += 1
-                        
-
-                    min_sum = min(min_sum, voice_sums[voice])
-
-            staff_zero = ''
+            # Symbol groups of staff string, joined once at the end
+            staff_zero = []
             
             idx = 0
             while idx < len(notes_to_add):
@@ -772,11 +794,11 @@ class MusicXML():
                 # Get all symbols from idx till symbol is add
                 symbols = [notes_to_add[idx]]
                 idx += 1
-                while '+ ' not in symbols and idx < len(notes_to_add):
+                while TOK_PLUS not in symbols and idx < len(notes_to_add):
                     symbols.append(notes_to_add[idx])
                     idx += 1
-                if '+ ' in symbols:
-                    symbols.remove('+ ')
+                if TOK_PLUS in symbols:
+                    symbols.remove(TOK_PLUS)
 
                 # If no symbols (only +) skip
                 if len(symbols) == 0:
@@ -786,30 +808,35 @@ class MusicXML():
                 symbols.sort(key=functools.cmp_to_key(self.compare_symbols))
 
                 # Add each symbol to staff string
-                staff_zero += '+ ' + ''.join(symbols)
+                staff_zero.append(TOK_PLUS)
+                staff_zero.extend(symbols)
             
             # Remove leading '+' from string
-            staves[0] = staff_zero
+            staves[0] = ''.join(staff_zero)
 
         # Add clef and key signature to front if new page and not already included
+        # (start of stave is only split again after something was prepended to it)
         for i in range(num_staves):
+            stave_start = self.get_stave_start(staves[i])
 
             if len(voice_lines) > 1:    # Add time/key/clef to polyphonic
                 
                 time_added = False
                 key_added = False
                 if new_score:
-                    if 'time' not in ''.join(staves[i].split()[:5]):
+                    if 'time' not in stave_start:
                         staves[i] = start_time + ' ' + staves[i]
+                        stave_start = self.get_stave_start(staves[i])
                         time_added = True
                 if new_page:
-                    if 'key' not in ''.join(staves[i].split()[:5]):
+                    if 'key' not in stave_start:
                         if time_added:
                             staves[i] = start_key + ' + ' + staves[i]
                         else:
                             staves[i] = start_key + ' ' + staves[i]
+                        stave_start = self.get_stave_start(staves[i])
                         key_added = True
-                    if 'clef' not in ''.join(staves[i].split()[:5]):
+                    if 'clef' not in stave_start:
                         if time_added or key_added:
                             staves[i] = start_clef + ' + ' + staves[i]
                         else:
@@ -819,17 +846,186 @@ class MusicXML():
             else:                       # Add time/key/clef to monophonic
                 
                 if new_score:       
-                    if 'time' not in ''.join(staves[i].split()[:5]):
+                    if 'time' not in stave_start:
                         staves[i] = start_time + ' ' + staves[i]
+                        stave_start = self.get_stave_start(staves[i])
                 if new_page:
-                    if 'key' not in ''.join(staves[i].split()[:5]):
+                    if 'key' not in stave_start:
                         staves[i] = start_key  + ' + ' + staves[i]
-                    if 'clef' not in ''.join(staves[i].split()[:5]):
+                        stave_start = self.get_stave_start(staves[i])
+                    if 'clef' not in stave_start:
                         staves[i] = start_clef + ' + ' + staves[i]
 
-        return staves, skip
+        return staves, state.skip
 
         
+    @staticmethod
+    def get_stave_start(stave):
+        """Return first 5 words of stave joined together (split stops after them)."""
+        return ''.join(stave.split(None, 5)[:5])
+
+    def read_attributes(self, elem, m, state):
+        """Read <attributes> element of a measure (key, time, clef, multirests)."""
+        # Parse the attributes element
+        # (Skip is number of measures to skip for multirest)
+        cur_elem, state.skip, self.beat, self.beat_type = m.parse_attributes(elem)
+
+        # Skip percussion/guitar music
+        if 'percussion' in cur_elem[0] or 'TAB' in cur_elem[0] or \
+            'percussion' in cur_elem or 'TAB' in cur_elem:
+            self.clef = 'percussion'
+            state.skip_measure = True
+
+        return cur_elem
+
+    def read_note(self, elem, m, state):
+        """Read <note> element of a measure and add it to its voice. Return None for skipped notes."""
+        voice_lines = state.voice_lines
+        forward_dur = state.forward_dur
+
+        # Parse note element and get the symbolic representation of it
+        cur_elem, state.is_chord, voice, duration, state.is_grace, _ = m.parse_note(elem)
+
+        # Check if new voice started
+        if state.cur_voice != voice and state.cur_voice != -1:
+
+            # Add any remaining forwards to previous voice
+            if len(forward_dur) != 0 and state.cur_voice in voice_lines:
+                state.add_symbol(state.cur_voice, TOK_FWD, forward_dur[-1])
+                del forward_dur[-1]
+
+        state.cur_voice = voice
+
+        # Skip multi staff notes
+        if cur_elem == 'multi-staff':
+            return None
+
+        # No print object case, include a duration, but don't generate symbol
+        if cur_elem == TOK_FWD:
+
+            if len(forward_dur) == 1:
+                forward_dur[0] += duration
+            else:
+                forward_dur.append(duration)
+
+        else:
+
+            # Update voicing stuff (for multi voice aka polyphony)
+            if voice not in voice_lines:
+                state.add_voice(voice)
+                if len(forward_dur) != 0:       # Handle weird case when voice added in middle of a measure
+                    state.add_symbol(voice, TOK_PLUS)
+                    state.add_symbol(voice, TOK_FWD, forward_dur[-1])
+                    del forward_dur[-1]
+
+            # If not a chord, append a '+' and 0 duration for it
+            if ((state.cur_staves[0] or state.staves[0] != '') and not state.is_chord and cur_elem[0] != '') \
+                    and not state.is_grace and not state.prev_grace:
+                state.add_symbol(voice, TOK_PLUS)
+                state.add_symbol(voice, cur_elem[0], duration)
+            else:
+                # Different behavior if first note of sequence
+                if state.staves[0] != '':
+                    state.add_symbol(voice, cur_elem[0])
+                else:
+                    state.add_symbol(voice, TOK_PLUS)
+                    state.add_symbol(voice, cur_elem[0], duration)
+
+        return cur_elem
+
+    def read_direction(self, elem, m, state):
+        """Read <direction> element of a measure (not used)."""
+        return m.parse_direction(elem)
+
+    def read_forward(self, elem, m, state):
+        """Read <forward> element of a measure (used for multi voice music)."""
+        state.forward_dur.append(int(elem[0].text))
+        return ['' for _ in range(state.num_staves)]
+
+    def read_backup(self, elem, m, state):
+        """Read <backup> element of a measure (switching voice indication)."""
+        forward_dur = state.forward_dur
+
+        # Add any remaining forwards to previous voice
+        if len(forward_dur) != 0 and state.cur_voice in state.voice_lines:
+            state.add_symbol(state.cur_voice, TOK_FWD, forward_dur[-1])
+            del forward_dur[-1]
+
+        forward_dur.clear()
+
+        state.cur_voice = -1
+        return ['' for _ in range(state.num_staves)]
+
+    @staticmethod
+    def merge_voices(voice_lines, voice_durations, total):
+        """
+        Merge symbols of all voices of a measure into one list ordered by time
+        (symbols starting at the same time are added together).
+
+        voice_lines: symbols of each voice
+        voice_durations: duration of each symbol of each voice
+        total: duration of the longest voice (all voices are padded to it)
+
+        Return None if voices can not be merged.
+        """
+        min_sum = 0
+        voice_idxs = dict()
+        # Heap of (sum of durations, voice order, voice), voice order keeps voices
+        # with the same sum in the order they appeared in the measure
+        voice_heap = []
+        for order, voice in enumerate(voice_lines):
+            voice_idxs[voice] = 0
+            voice_heap.append((0, order, voice))
+        notes_to_add = []
+
+        while min_sum < total:
+
+            # Take all voices with the minimal sum of durations to current timestep
+            min_sum = voice_heap[0][0]
+            cur_voices = []
+            while voice_heap and voice_heap[0][0] == min_sum:
+                cur_voices.append(heapq.heappop(voice_heap))
+            cur_voices.sort()
+
+            progressed = False
+            for voice_sum, order, voice in cur_voices:
+                line = voice_lines[voice]
+                durations = voice_durations[voice]
+                idx = voice_idxs[voice]
+
+                if idx < len(line):
+                    progressed = True
+
+                    if (len(notes_to_add) == 0 or (notes_to_add[-1] is not TOK_PLUS or line[idx] is not TOK_PLUS)) \
+                        and line[idx] is not TOK_FWD:
+                        notes_to_add.append(line[idx])
+
+                    # Update current voice
+                    voice_sum += durations[idx]
+                    idx += 1
+
+                    # Add the rest of chord if relevant (keep adding till + encountered)
+                    while idx < len(line) and \
+                          ((line[idx] is not TOK_PLUS and notes_to_add[-1] is not TOK_PLUS) or \
+                          line[idx] is TOK_BARLINE):
+
+                        # Only add if not a 'forward'
+                        if line[idx] is not TOK_FWD:
+                            notes_to_add.append(line[idx])
+
+                        voice_sum += durations[idx]
+                        idx += 1
+
+                    voice_idxs[voice] = idx
+
+                heapq.heappush(voice_heap, (voice_sum, order, voice))
+
+            # All voices with minimal sum are used up, merging would never end
+            if not progressed and min_sum < total:
+                return None
+
+        return notes_to_add
+
     def compare_symbols(self, a, b):
 
         """
@@ -849,10 +1045,8 @@ class MusicXML():
 
         # Note case
         if 'note' in a and 'note' in b:
-            a_note = self.note_to_num(''.join(a.split('-')[1].split('_')[0][:-1]))
-            a_oct = int(a.split('_')[0][-1])
-            b_note = self.note_to_num(''.join(b.split('-')[1].split('_')[0][:-1]))
-            b_oct = int(b.split('_')[0][-1])
+            a_oct, a_note = self.note_sort_key(a)
+            b_oct, b_note = self.note_sort_key(b)
             if a_oct > b_oct:
                 ret_val = 1
             elif a_oct == b_oct:
@@ -870,41 +1064,18 @@ class MusicXML():
 
         return ret_val
 
-    def note_to_num(self, note):
+    def note_sort_key(self, note):
 
         """
-        Converts note to num for purpose of sorting
+        Returns (octave, note num) of note symbol for compare_symbols,
+        each symbol is parsed only once per file
         """
 
-        note_dict = {
-            'Cb': 0,
-            'C': 1,
-            'C#': 2,
-            'Db': 2,
-            'D': 3,
-            'D#': 4,
-            'Eb': 4,
-            'E': 5,
-            'E#': 6,
-            'Fb': 6,
-            'F': 7,
-            'F#': 8,
-            'Gb': 8,
-            'G': 9,
-            'G#': 10,
-            'Ab': 10,
-            'A': 11,
-            'A#': 12,
-            'Bb': 12,
-            'B': 13,
-            'B#': 14,
-        }
-
-        try:
-            return note_dict[note]
-        except KeyError:
-            try:
-                return note_dict[note[:-1]]
-            except KeyError:
-                print('Error with note dict?',note)
-                return 0
\ No newline at end of file
+        key = self._note_sort_keys.get(note)
+        if key is None:
+            # note-<pitch><octave>_<duration>
+            pitch_octave = note.partition('_')[0]
+            key = (int(pitch_octave[-1]),
+                   note_to_num(pitch_octave.partition('-')[2][:-1]))
+            self._note_sort_keys[note] = key
+        return key
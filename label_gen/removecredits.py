@@ -8,6 +8,11 @@ import time
 
 from lxml import etree
 
+# Elements removed from MusicXMLs
+REMOVED_TAGS = frozenset(('credit', 'rights', 'lyric', 'direction'))
+# Elements with text cleared
+CLEARED_TAGS = frozenset(('part-name', 'instrument-name', 'part-abbreviation'))
+
 def main():
 
     """
@@ -25,50 +30,41 @@ def main():
                         help='Path to the input directory with MusicXMLs.')
     args = parser.parse_args()
 
-    # Go through all files in input directory
-    files = os.listdir(args.input)
+    # Go through all .musicxml files in input directory
+    # (scandir reuses file type from directory listing, no extra stat per file)
+    with os.scandir(args.input) as entries:
+        files = [e.path for e in entries if e.name.endswith('.musicxml') and e.is_file()]
     print(f'Going through {len(files)} files, every dot is 200 files. ')
-    for i, file_name in enumerate(files):
+    for i, input_file in enumerate(files):
         if i % 200 == 0:
             print('.', end='')
             sys.stdout.flush()
-        # Make sure file is .musicxml
-        if not file_name.endswith('.musicxml'):
-            continue
-
-        input_file = os.path.join(args.input, file_name)
 
-        # Create parse tree
+        # Create parse tree, collecting elements to change while parsing
+        # (instead of searching the whole tree for each of them afterwards,
+        # no table of xml:id attributes is built, they are never looked up)
+        removed_elems = []
         try:
-            doc=etree.parse(input_file)
+            context = etree.iterparse(input_file, events=('end',),
+                                      tag=REMOVED_TAGS | CLEARED_TAGS, collect_ids=False)
+            for _, elem in context:
+                if elem.tag in CLEARED_TAGS:
+                    elem.text = ''
+                else:
+                    removed_elems.append(elem)
+            doc = context.root.getroottree()
         except:
             os.remove(input_file)
             continue
 
-        # Remove credits/rights text that could interfere with music 
-        for elem in doc.xpath('//credit'):
-            parent = elem.getparent()
-            parent.remove(elem)
-        for elem in doc.xpath('//rights'):
-            parent = elem.getparent()
-            parent.remove(elem)
-        for elem in doc.xpath('//lyric'):
-            parent = elem.getparent()
-            parent.remove(elem)
-        for elem in doc.xpath('//part-name'):
-            elem.text = ''
-        for elem in doc.xpath('//instrument-name'):
-            elem.text = ''
-        for elem in doc.xpath('//part-abbreviation'):
-            elem.text = ''
-        for elem in doc.xpath('//direction'):
+        # Remove credits/rights text that could interfere with music
+        # (only after parsing, when tail text of elements is known and removed with them)
+        for elem in removed_elems:
             parent = elem.getparent()
             parent.remove(elem)
 
         # Write to same file with next XML
-        f = open(input_file, 'wb')
-        f.write(etree.tostring(doc))
-        f.close()
+        doc.write(input_file)
         num_files += 1
 
     end = time.time()
@@ -21,11 +21,18 @@ import re
 import time
 import logging
 import json
+import multiprocessing
+from typing import TYPE_CHECKING
 
 import music21 as music
 
 from music_structures import Measure
-from pero_ocr.core.layout import PageLayout, RegionLayout, TextLine
+
+if TYPE_CHECKING:
+    from pero_ocr.core.layout import RegionLayout, TextLine
+
+# Line of transcription file: `ID<extension> [number] "labels"`
+LABEL_LINE_RE = re.compile(r'([a-zA-Z0-9_\-]+)[a-zA-Z0-9_\.]+\s+([0-9]+\s+)?\"([\S\s]+)\"')
 
 
 def parseargs():
@@ -52,6 +59,9 @@ def parseargs():
     parser.add_argument(
         '-v', "--verbose", action='store_true', default=False,
         help="Activate verbose logging.")
+    parser.add_argument(
+        '-j', '--jobs', type=int, default=os.cpu_count(),
+        help="Number of worker processes converting lines of transcription files in parallel.")
 
     return parser.parse_args()
 
@@ -67,7 +77,8 @@ def main():
         translator_path=args.translator_path,
         output_folder=args.output_folder,
         export_midi=args.export_midi,
-        verbose=args.verbose)()
+        verbose=args.verbose,
+        jobs=args.jobs)()
 
     end = time.time()
     print(f'Total time: {end - start:.2f} s')
@@ -79,7 +90,7 @@ class ExportMusicPage:
     def __init__(self, input_xml_path: str = '', translator_path: str = '',
                  input_transcription_files: list[str] = None,
                  output_folder: str = 'output_page', export_midi: bool = False,
-                 verbose: bool = False):
+                 verbose: bool = False, jobs: int = 1):
         self.translator_path = translator_path
         if verbose:
             logging.basicConfig(level=logging.DEBUG, format='[%(levelname)-s]  \t- %(message)s')
@@ -97,18 +108,22 @@ class ExportMusicPage:
             os.makedirs(output_folder)
         self.output_folder = output_folder
         self.export_midi = export_midi
+        self.jobs = jobs
 
         self.translator = Translator(file_name=self.translator_path)
 
     def __call__(self) -> None:
         if self.input_transcription_files:
             ExportMusicLines(input_files=self.input_transcription_files, output_folder=self.output_folder,
-                             translator=self.translator, verbose=self.verbose)()
+                             translator=self.translator, verbose=self.verbose, jobs=self.jobs)()
 
         if self.input_xml_path:
             self.export_xml()
 
     def export_xml(self) -> None:
+        # Imported here, pero-ocr is only needed for pages, not for transcription files
+        from pero_ocr.core.layout import PageLayout
+
         page = PageLayout(file=self.input_xml_path)
         print(f'Page {self.input_xml_path} loaded successfully.')
 
@@ -136,7 +151,7 @@ class ExportMusicPage:
 
     def get_output_file_base(self) -> str:
         input_file = os.path.basename(self.input_xml_path)
-        name, *_ = re.split(r'\.', input_file)
+        name = input_file.partition('.')[0]
         return os.path.join(self.output_folder, f'{name}')
 
     def export_to_midi(self, score, parts):
@@ -152,7 +167,7 @@ class ExportMusicPage:
     def regions_to_parts(regions: list[RegionLayout], translator, export_midi: bool = False
                          ) -> list:  # -> list[Part]:
         """Takes a list of regions and splits them to parts."""
-        max_parts = max([len(region.lines) for region in regions])
+        max_parts = max(len(region.lines) for region in regions)
 
         # TODO add empty measure padding to parts without textlines in multi-part scores.
 
@@ -167,9 +182,10 @@ class ExportMusicPage:
 class ExportMusicLines:
     """Takes text files with transcriptions as individual lines and exports musicxml file for each one"""
     def __init__(self, translator: Translator, input_files: list[str] = None,
-                 output_folder: str = 'output_musicxml', verbose: bool = False):
+                 output_folder: str = 'output_musicxml', verbose: bool = False, jobs: int = 1):
         self.translator = translator
         self.output_folder = output_folder
+        self.jobs = max(1, jobs or 1)
 
         if verbose:
             logging.basicConfig(level=logging.DEBUG, format='[%(levelname)-s]  \t- %(message)s')
@@ -186,35 +202,47 @@ class ExportMusicLines:
             logging.error('No input files provided. Exiting...')
             sys.exit(1)
 
-        # For every file, convert it to MusicXML
+        # Collect lines of all files first, each line is then converted to MusicXML independently
+        # (by output file, so a later line with the same ID still overwrites an earlier one)
+        lines_to_export = {}
+        output_prefix = os.path.join(self.output_folder, '')
         for input_file_name in self.input_files:
-            logging.info(f'Reading file {input_file_name}')
+            logging.info('Reading file %s', input_file_name)
             lines = ExportMusicLines.read_file_lines(input_file_name)
 
             for i, line in enumerate(lines):
-                match = re.fullmatch(r'([a-zA-Z0-9_\-]+)[a-zA-Z0-9_\.]+\s+([0-9]+\s+)?\"([\S\s]+)\"', line)
+                match = LABEL_LINE_RE.fullmatch(line)
 
                 if not match:
-                    logging.debug(f'NOT MATCHING PATTERN. Skipping line {i} in file {input_file_name}: '
-                                  f'({line[:min(50, len(line))]}...)')
+                    logging.debug('NOT MATCHING PATTERN. Skipping line %d in file %s: (%s...)',
+                                  i, input_file_name, line[:50])
                     continue
 
                 stave_id = match.group(1)
                 labels = match.group(3)
                 labels = self.translator.convert_line(labels, to_shorter=False)
-                output_file_name = os.path.join(self.output_folder, f'{stave_id}.musicxml')
-
-                parsed_labels = semantic_line_to_music21_score(labels)
-                if not isinstance(parsed_labels, music.stream.Stream):
-                    logging.error(f'Labels could not be parsed. Skipping line {i} in file {input_file_name}: '
-                                  f'({line[:min(50, len(line))]}...)')
-                    continue
-
-                logging.info(f'Parsing successfully completed.')
-                # parsed_labels.show()  # Show parsed labels in some visual program (MuseScore by default)
-
-                xml = music21_to_musicxml(parsed_labels)
-                write_to_file(output_file_name, xml)
+                output_file_name = f'{output_prefix}{stave_id}.musicxml'
+                line_info = f'line {i} in file {input_file_name}: ({line[:min(50, len(line))]}...)'
+
+                lines_to_export[output_file_name] = labels, line_info
+
+        # Lines with the same labels are converted only once and written to all their output files
+        files_by_labels = {}
+        for output_file_name, (labels, line_info) in lines_to_export.items():
+            if labels in files_by_labels:
+                files_by_labels[labels][1].append(output_file_name)
+            else:
+                files_by_labels[labels] = labels, [output_file_name], line_info
+        labels_to_export = files_by_labels.values()
+
+        # music21 is pure Python, lines are converted in worker processes to use all cores
+        if self.jobs == 1:
+            for line_to_export in labels_to_export:
+                export_line_to_musicxml(line_to_export)
+        else:
+            with multiprocessing.Pool(self.jobs) as pool:
+                for _ in pool.imap_unordered(export_line_to_musicxml, labels_to_export, chunksize=8):
+                    pass
 
     @staticmethod
     def prepare_output_folder(output_folder: str):
@@ -228,21 +256,35 @@ class ExportMusicLines:
         if not input_files:
             return []
 
+        # List each folder once (scandir reuses file type from directory listing, no stat per input file)
+        files_in_folders = {}
         for input_file in input_files:
-            if os.path.isfile(input_file):
+            folder, file_name = os.path.split(input_file)
+            if folder not in files_in_folders:
+                files_in_folders[folder] = ExportMusicLines.get_files_in_folder(folder or '.')
+            if file_name in files_in_folders[folder]:
                 existing_files.append(input_file)
 
         return existing_files
 
+    @staticmethod
+    def get_files_in_folder(folder: str) -> set[str]:
+        try:
+            with os.scandir(folder) as entries:
+                return {e.name for e in entries if e.is_file()}
+        except OSError:
+            return set()
+
     @staticmethod
     def read_file_lines(input_file: str) -> list[str]:
         with open(input_file, 'r', encoding='utf-8') as f:
-            lines = f.read().splitlines()
+            text = f.read()
 
-        if not lines:
-            logging.warning(f'File {input_file} is empty!')
+        if not text:
+            logging.warning('File %s is empty!', input_file)
 
-        return [line for line in lines if line]
+        # Skip empty lines while building the list
+        return list(filter(None, text.splitlines()))
 
 
 class Part:
@@ -252,24 +294,26 @@ class Part:
         self.translator = translator
 
         self.repr_music21 = music.stream.Part([music.instrument.Piano()])
-        self.labels: list[str] = []
         self.textlines: list[TextLineWrapper] = []
-        self.measures: list[Measure] = []  # List of measures in internal representation, NOT music21
+        # Only count of measures and last clef of previous line are needed, not whole internal representation
+        self.measure_count = 0
+        self.last_clef = None
 
     def add_textline(self, line: TextLine) -> None:
         labels = self.translator.convert_line(line.transcription, False)
-        self.labels.append(labels)
 
         new_measures = parse_semantic_to_measures(labels)
 
         # Delete first clef symbol of first measure in line if same as last clef in previous line
-        if len(self.measures) and new_measures[0].get_start_clef() == self.measures[-1].last_clef:
+        if self.measure_count and new_measures[0].get_start_clef() == self.last_clef:
             new_measures[0].delete_clef_symbol()
 
-        new_measures_encoded = encode_measures(new_measures, len(self.measures) + 1)
+        new_measures_encoded = encode_measures(new_measures, self.measure_count + 1)
         new_measures_encoded_without_measure_ids = encode_measures(new_measures)
 
-        self.measures += new_measures
+        if new_measures:
+            self.measure_count += len(new_measures)
+            self.last_clef = new_measures[-1].last_clef
         self.repr_music21.append(new_measures_encoded)
 
         self.textlines.append(TextLineWrapper(line, new_measures_encoded_without_measure_ids))
@@ -289,7 +333,7 @@ class TextLineWrapper:
     """Class to wrap one TextLine for easier export etc."""
     def __init__(self, text_line: TextLine, measures: list[music.stream.Measure]):
         self.text_line = text_line
-        print(f'len of measures: {len(measures)}')
+        logging.debug('len of measures: %d', len(measures))
         self.repr_music21 = music.stream.Part([music.instrument.Piano()] + measures)
 
     def export_midi(self, file_base: str = 'out'):
@@ -309,21 +353,31 @@ class Translator:
 
     def convert_line(self, line, to_shorter: bool = True):
         line = line.strip('"').strip()
-        symbols = re.split(r'\s+', line)
-        converted_symbols = [self.convert_symbol(symbol, to_shorter) for symbol in symbols]
+        dictionary = self.translator if to_shorter else self.translator_reversed
+
+        converted_symbols = []
+        for symbol in line.split():
+            converted = dictionary.get(symbol)
+            if converted is None:
+                converted = self.report_missing(symbol)
+            converted_symbols.append(converted)
 
         return ' '.join(converted_symbols)
 
     def convert_symbol(self, symbol: str, to_shorter: bool = True):
         dictionary = self.translator if to_shorter else self.translator_reversed
 
-        try:
-            return dictionary[symbol]
-        except KeyError:
-            if symbol not in self.n_existing_labels:
-                self.n_existing_labels.add(symbol)
-                print(f'Not existing label: ({symbol})')
-            return ''
+        converted = dictionary.get(symbol)
+        if converted is None:
+            return self.report_missing(symbol)
+        return converted
+
+    def report_missing(self, symbol: str) -> str:
+        """Print not existing label (only the first time) and return empty replacement."""
+        if symbol not in self.n_existing_labels:
+            self.n_existing_labels.add(symbol)
+            print(f'Not existing label: ({symbol})')
+        return ''
 
     @staticmethod
     def read_json(filename) -> dict:
@@ -339,26 +393,22 @@ def parse_semantic_to_measures(labels: str) -> list[Measure]:
     """
     labels = labels.strip('"')
 
-    measures_labels = re.split(r'barline', labels)
-
-    stripped_measures_labels = []
-    for measure_label in measures_labels:
-        stripped = measure_label.strip().strip('+').strip()
-        if stripped:
-            stripped_measures_labels.append(stripped)
-
-    measures = [Measure(measure_label) for measure_label in stripped_measures_labels if measure_label]
-
+    # Measures are created and get their key and last clef from the previous measure in one pass
+    measures = []
     previous_measure_key = music.key.Key()  # C Major as a default key (without accidentals)
-    for measure in measures:
+    previous_measure_last_clef = music.clef.TrebleClef  # Default of Measure.get_last_clef
+    for measure_label in labels.split('barline'):
+        measure_label = measure_label.strip().strip('+').strip()
+        if not measure_label:
+            continue
+
+        measure = Measure(measure_label)
         previous_measure_key = measure.get_key(previous_measure_key)
+        previous_measure_last_clef = measure.get_last_clef(previous_measure_last_clef)
+        measures.append(measure)
 
     measures[0].new_system = True
 
-    previous_measure_last_clef = measures[0].get_last_clef()
-    for measure in measures[1:]:
-        previous_measure_last_clef = measure.get_last_clef(previous_measure_last_clef)
-
     return measures
 
 
@@ -389,17 +439,38 @@ def semantic_line_to_music21_score(labels: str) -> music.stream.Score:
     return stream
 
 
-def music21_to_musicxml(music_object):
+def export_line_to_musicxml(line_to_export: tuple) -> None:
+    """Convert one line of semantic labels and write it as MusicXML to all its output files.
+
+    Args:
+        line_to_export (tuple): (labels, list of output file names, line description for logging)
+    """
+    labels, output_file_names, line_info = line_to_export
+
+    parsed_labels = semantic_line_to_music21_score(labels)
+    if not isinstance(parsed_labels, music.stream.Stream):
+        logging.error('Labels could not be parsed. Skipping %s', line_info)
+        return
+
+    logging.info('Parsing successfully completed.')
+    # parsed_labels.show()  # Show parsed labels in some visual program (MuseScore by default)
+
+    xml = music21_to_musicxml(parsed_labels)
+    for output_file_name in output_file_names:
+        write_to_file(output_file_name, xml)
+
+
+def music21_to_musicxml(music_object) -> bytes:
+    """Export music21 object to MusicXML, kept as UTF-8 encoded bytes (no decoding and encoding again on write)."""
     out_bytes = music.musicxml.m21ToXml.GeneralObjectExporter(music_object).parse()
-    out_str = out_bytes.decode('utf-8')
-    return out_str.strip()
+    return out_bytes.strip()
 
 
-def write_to_file(output_file_name, xml):
-    with open(output_file_name, 'w', encoding='utf-8') as f:
+def write_to_file(output_file_name, xml: bytes):
+    with open(output_file_name, 'wb') as f:
         f.write(xml)
 
-    logging.info(f'File {output_file_name} successfully written.')
+    logging.info('File %s successfully written.', output_file_name)
 
 
 if __name__ == "__main__":
@@ -7,27 +7,32 @@ Contact: xvlach22@vutbr.cz
 """
 
 from __future__ import annotations
-import re
 from enum import Enum
 import logging
+import bisect
 
 import music21 as music
-from music_symbols import Symbol, SymbolType, AlteredPitches, LENGTH_TO_SYMBOL
+from music_symbols import Symbol, SymbolType, AlteredPitches, LENGTH_TO_SYMBOL, NOTE_TYPES
+
+# Lengths of rests used for padding voices in ascending order
+PADDING_LENGTHS = sorted(LENGTH_TO_SYMBOL)
 
 
 class Measure:
-    _is_polyphonic = None
-    keysignature = None
-    repr = None
-    new_system = False
-    start_clef = None
-    last_clef = None
+    __slots__ = ('labels', 'symbol_groups', '_is_polyphonic', 'keysignature', 'repr', 'new_system',
+                 'start_clef', 'last_clef')
 
     def __init__(self, labels: str):
         """Takes labels corresponding to a single measure."""
         self.labels = labels
+        self._is_polyphonic = None
+        self.keysignature = None
+        self.repr = None
+        self.new_system = False
+        self.start_clef = None
+        self.last_clef = None
 
-        label_groups = re.split(r'\+', self.labels)
+        label_groups = self.labels.split('+')
         stripped_label_groups = []
         for measure_label in label_groups:
             stripped = measure_label.strip().strip('+').strip()
@@ -129,8 +134,9 @@ class Measure:
         if self.new_system:
             self.repr.insert(0, music.layout.SystemLayout(isNew=True))
 
+        # Measure is formatted to string by logging only if debug messages are really printed
         logging.debug('Current measure:')
-        logging.debug(str(self))
+        logging.debug('%s', self)
 
         logging.debug('Current measure ENCODED:')
         return self.repr
@@ -141,10 +147,10 @@ class Measure:
         Returns:
             music.stream.Measure: music21 representation of the measure.
         """
-        voice_count = max([symbol_group.get_voice_count() for symbol_group in self.symbol_groups])
+        voice_count = max(symbol_group.get_voice_count() for symbol_group in self.symbol_groups)
         voices = [Voice() for _ in range(voice_count)]
         logging.debug('-------------------------------- NEW MEASURE --------------------------------')
-        logging.debug(f'voice_count: {voice_count}')
+        logging.debug('voice_count: %s', voice_count)
 
         zero_length_symbol_groups = Measure.find_zero_length_symbol_groups(self.symbol_groups)
         remaining_symbol_groups = self.symbol_groups[len(zero_length_symbol_groups):]
@@ -159,14 +165,14 @@ class Measure:
             groups_to_add = symbol_group.get_groups_to_add()
             shortest_voice_ids = Measure.pad_voices_to_n_shortest(voices, len(groups_to_add))
 
-            logging.debug(
-                f'Zipping {len(groups_to_add)} symbol groups to shortest voices ({len(shortest_voice_ids)}): {shortest_voice_ids}')
+            logging.debug('Zipping %s symbol groups to shortest voices (%s): %s',
+                          len(groups_to_add), len(shortest_voice_ids), shortest_voice_ids)
             for voice_id, group in zip(shortest_voice_ids, groups_to_add):
-                logging.debug(f'Voice ({voice_id}) adding: {group}')
+                logging.debug('Voice (%s) adding: %s', voice_id, group)
                 voices[voice_id].add_symbol_group(group)
 
             for voice_id, voice in enumerate(voices):
-                logging.debug(f'voice ({voice_id}) len: {voice.length}')
+                logging.debug('voice (%s) len: %s', voice_id, voice.length)
 
         zero_length_encoded = [group.encode_to_music21_monophonic() for group in zero_length_symbol_groups]
         voices_repr = [voice.encode_to_music21_monophonic() for voice in voices]
@@ -223,7 +229,7 @@ class Measure:
         shortest_voice_ids = Measure.find_shortest_voices(voices)
 
         while n > len(shortest_voice_ids):
-            logging.debug(f'Found {len(shortest_voice_ids)} shortest voices, desired voices: {n}.')
+            logging.debug('Found %s shortest voices, desired voices: %s.', len(shortest_voice_ids), n)
             second_shortest_voice_ids = Measure.find_shortest_voices(voices, ignore=shortest_voice_ids)
             second_shortest_len = voices[second_shortest_voice_ids[0]].length
             for voice_id in shortest_voice_ids:
@@ -280,15 +286,18 @@ class SymbolGroupType(Enum):
 
 class SymbolGroup:
     """Represents one label group in a measure. Consisting of 1 to n labels/symbols."""
-    tuple_data: list = None  # Tuple data consists of a list of symbol groups where symbols have same lengths.
-    length: float = None   # Length of the symbol group in quarter notes.
+    __slots__ = ('labels', 'type', 'symbols', 'tuple_data', 'length')
 
-    def __init__(self, labels: str):
+    def __init__(self, labels: str, symbols: list = None):
         self.labels = labels
         self.type = SymbolGroupType.UNKNOWN
+        self.tuple_data: list = None  # Tuple data consists of a list of symbol groups where symbols have same lengths.
+        self.length: float = None   # Length of the symbol group in quarter notes.
 
-        label_group_parsed = re.split(r'\s', self.labels.strip())
-        self.symbols = [Symbol(label_group) for label_group in label_group_parsed if label_group]
+        if symbols is None:
+            label_group_parsed = self.labels.split()
+            symbols = [Symbol(label_group) for label_group in label_group_parsed]
+        self.symbols = symbols
 
         self.type = self.get_type()
         if self.type == SymbolGroupType.TUPLE:
@@ -310,17 +319,19 @@ class SymbolGroup:
 
     def get_type(self):
         if len(self.symbols) == 0:
-            logging.warning(f'No symbols found in label group: {self.labels}')
+            logging.warning('No symbols found in label group: %s', self.labels)
             return SymbolGroupType.UNKNOWN
         elif len(self.symbols) == 1:
-            self.length = self.symbols[0].get_length()
+            self.length = self.symbols[0].length
             return SymbolGroupType.SYMBOL
         else:
-            same_length_notes = all((symbol.get_length() == self.symbols[0].get_length() and
-                                     symbol.type in [SymbolType.NOTE, SymbolType.GRACENOTE])
+            # Lengths were already computed when symbols were created
+            first_length = self.symbols[0].length
+            same_length_notes = all((symbol.length == first_length and
+                                     symbol.type in NOTE_TYPES)
                                     for symbol in self.symbols)
             if same_length_notes:
-                self.length = self.symbols[0].get_length()
+                self.length = first_length
                 return SymbolGroupType.CHORD
             else:
                 return SymbolGroupType.TUPLE
@@ -358,13 +369,13 @@ class SymbolGroup:
             return self.symbols[0].repr
         elif self.type == SymbolGroupType.CHORD:
             notes = [symbol.repr for symbol in self.symbols]
-            logging.debug(f'notes: {notes}')
+            logging.debug('notes: %s', notes)
             return music.chord.Chord(notes)
             # return music.stream.Stream(music.chord.Chord(notes))
         elif self.type == SymbolGroupType.EMPTY:
             return music.stream.Stream()
         elif self.type == SymbolGroupType.TUPLE:
-            logging.info(f'Tuple label group not supported yet, returning empty stream.')
+            logging.info('Tuple label group not supported yet, returning empty stream.')
             return music.stream.Stream()
         else:
             return music.stream.Stream()
@@ -375,27 +386,27 @@ class SymbolGroup:
         Tuple data consists of a list of symbol groups where symbols have same lengths.
         """
         # logging.debug(f'Creating tuple data for label group: {self.labels}')
-        list_of_groups = [[self.symbols[0]]]
-        for symbol in self.symbols[1:]:
-            if symbol.type == SymbolType.REST:
-                list_of_groups.append([symbol])
-                continue
-            symbol_length = symbol.get_length()
-            for group in list_of_groups:
-                # if symbol_length == group[0].get_length() and symbol.type in [SymbolType.NOTE, SymbolType.GRACENOTE]:
-                if group[0].type in [SymbolType.NOTE, SymbolType.GRACENOTE] and symbol_length == group[0].get_length():
+        list_of_groups = []
+        note_groups = {}  # First group starting with a note of given length, other symbols of that length join it
+        for symbol in self.symbols:
+            if symbol.type != SymbolType.REST:
+                group = note_groups.get(symbol.length)
+                if group is not None:
                     group.append(symbol)
-                    break
-            else:
-                list_of_groups.append([symbol])
+                    continue
+
+            group = [symbol]
+            list_of_groups.append(group)
+            if symbol.type in NOTE_TYPES:
+                note_groups.setdefault(symbol.length, group)
 
         # logging.debug(list_of_groups)
 
+        # Symbols are already parsed, sub-groups take them instead of parsing their labels again
         self.tuple_data = []
         for group in list_of_groups:
-            labels = [symbol.label for symbol in group]
-            labels = ' '.join(labels)
-            self.tuple_data.append(SymbolGroup(labels))
+            labels = ' '.join(symbol.label for symbol in group)
+            self.tuple_data.append(SymbolGroup(labels, symbols=group))
 
     def get_voice_count(self):
         """Returns the number of voices in the label group (count of groups in tuple group)
@@ -417,9 +428,9 @@ class SymbolGroup:
             groups_to_add = [self]
             # return [self]
 
-        logging.debug(f'groups_to_add:')
+        logging.debug('groups_to_add:')
         for group in groups_to_add:
-            logging.debug(f'{group}')
+            logging.debug('%s', group)
 
         return groups_to_add
 
@@ -431,13 +442,11 @@ class SymbolGroup:
 
 class Voice:
     """Internal representation of voice (list of symbol groups symbolizing one musical line)."""
-    length: float = 0.0   # Accumulated length of symbol groups (in quarter notes).
-    symbol_groups: list = []
-    repr = None
+    __slots__ = ('length', 'symbol_groups', 'repr')
 
     def __init__(self):
-        self.length = 0.0
-        self.symbol_groups = []
+        self.length: float = 0.0   # Accumulated length of symbol groups (in quarter notes).
+        self.symbol_groups: list = []
         self.repr = None
 
     def __str__(self):
@@ -452,7 +461,7 @@ class Voice:
 
     def add_symbol_group(self, symbol_group: SymbolGroup) -> None:
         if symbol_group.type == SymbolGroupType.TUPLE:
-            logging.warning(f'Can NOT add symbol group of type TUPLE to a voice.')
+            logging.warning('Can NOT add symbol group of type TUPLE to a voice.')
             return
         self.symbol_groups.append(symbol_group)
         self.length += symbol_group.length
@@ -481,22 +490,22 @@ class Voice:
         Args:
             padding_length (float): desired length of the padding in quarter notes.
         """
-        lengths = list(LENGTH_TO_SYMBOL.values())
-        min_length = min(LENGTH_TO_SYMBOL.keys())
+        min_length = PADDING_LENGTHS[0]
 
         while padding_length > 0:
             if padding_length in LENGTH_TO_SYMBOL:
                 length_label = LENGTH_TO_SYMBOL[padding_length]
-                logging.debug(f'Completing padding with padding length {padding_length} to the voice.')
+                logging.debug('Completing padding with padding length %s to the voice.', padding_length)
                 self.add_symbol_group(SymbolGroup(f'rest-{length_label}'))
                 padding_length -= padding_length
             elif padding_length < min_length:
-                logging.error(f'Padding length {padding_length} is smaller than the minimum length {min}, breaking.')
+                logging.error('Padding length %s is smaller than the minimum length %s, breaking.', padding_length,
+                              min_length)
                 break
             else:
                 # Step is the biggest number lower than desired padding length.
-                step = lengths[lengths < padding_length].max()
-                logging.debug(f'Adding padding STEP {step} to the voice.')
+                step = PADDING_LENGTHS[bisect.bisect_left(PADDING_LENGTHS, padding_length) - 1]
+                logging.debug('Adding padding STEP %s to the voice.', step)
 
                 length_label = LENGTH_TO_SYMBOL[step]
                 self.add_symbol_group(SymbolGroup(f'rest-{length_label}'))
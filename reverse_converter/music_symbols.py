@@ -12,7 +12,6 @@ Contact: xvlach22@vutbr.cz
 from __future__ import annotations
 import logging
 from enum import Enum
-import re
 
 import music21 as music
 
@@ -29,8 +28,15 @@ class SymbolType(Enum):
     UNKNOWN = 99
 
 
+# Symbol types of notes and of symbols with musical length
+# (tuples, membership is tested by identity without calling Enum.__hash__)
+NOTE_TYPES = (SymbolType.NOTE, SymbolType.GRACENOTE)
+LENGTH_TYPES = (SymbolType.REST, SymbolType.NOTE, SymbolType.GRACENOTE)
+
+
 class Symbol:
     """Represents one label in a label group."""
+    __slots__ = ('label', 'type', 'repr', 'length')
 
     def __init__(self, label: str):
         self.label = label
@@ -46,13 +52,13 @@ class Symbol:
         (half note: 2 quarter notes, eighth note: 0.5 quarter notes, ...)
         If the symbol does not have musical length, returns 0.
         """
-        if self.type in [SymbolType.REST, SymbolType.NOTE, SymbolType.GRACENOTE]:
+        if self.type in LENGTH_TYPES:
             return self.repr.duration.quarterLength
         else:
             return 0
 
     def set_key(self, altered_pitches: AlteredPitches):
-        if self.type in [SymbolType.NOTE, SymbolType.GRACENOTE]:
+        if self.type in NOTE_TYPES:
             self.repr = self.repr.get_real_height(altered_pitches)
 
     @staticmethod
@@ -62,32 +68,17 @@ class Symbol:
         Args:
             label (str): one symbol in semantic format as string
         """
-        if label.startswith("clef-"):
-            label = label[len('clef-'):]
-            return SymbolType.CLEF, Symbol.clef_to_symbol(label)
-        elif label.startswith("gracenote-"):
-            label = label[len('gracenote-'):]
-            return SymbolType.GRACENOTE, Symbol.note_to_symbol(label, gracenote=True)
-        elif label.startswith("keySignature-"):
-            label = label[len('keySignature-'):]
-            return SymbolType.KEY_SIGNATURE, Symbol.keysignature_to_symbol(label)
-        elif label.startswith("multirest-"):
-            label = label[len('multirest-'):]
-            return SymbolType.MULTI_REST, Symbol.multirest_to_symbol(label)
-        elif label.startswith("note-"):
-            label = label[len('note-'):]
-            return SymbolType.NOTE, Symbol.note_to_symbol(label)
-        elif label.startswith("rest-"):
-            label = label[len('rest-'):]
-            return SymbolType.REST, Symbol.rest_to_symbol(label)
+        # Dispatch by label prefix (part before first '-') instead of testing prefixes one by one
+        prefix, dash, label_rest = label.partition('-')
+        converter = LABEL_PREFIX_TO_SYMBOL.get(prefix) if dash else None
+        if converter is not None:
+            symbol_type, to_symbol = converter
+            return symbol_type, to_symbol(label_rest)
         elif label.startswith("tie"):
             label = label[len('tie'):]
             return SymbolType.TIE, Symbol.tie_to_symbol(label)
-        elif label.startswith("timeSignature-"):
-            label = label[len('timeSignature-'):]
-            return SymbolType.TIME_SIGNATURE, Symbol.timesignature_to_symbol(label)
 
-        logging.info(f'Unknown label: {label}, returning None.')
+        logging.info('Unknown label: %s, returning None.', label)
         return SymbolType.UNKNOWN, None
 
     @staticmethod
@@ -101,7 +92,7 @@ class Symbol:
             music.clef: one clef in music21 format
         """
         if len(clef) != 2:
-            logging.info(f'Unknown clef label: {clef}, returning default clef.')
+            logging.info('Unknown clef label: %s, returning default clef.', clef)
             return music.clef.Clef()
 
         return music.clef.clefFromString(clef)
@@ -117,7 +108,7 @@ class Symbol:
             music.key.Key: one key in music21 format
         """
         if not keysignature:
-            logging.info(f'Unknown key signature label: {keysignature}, returning default key.')
+            logging.info('Unknown key signature label: %s, returning default key.', keysignature)
             return music.key.Key()
 
         return music.key.Key(keysignature)
@@ -133,7 +124,7 @@ class Symbol:
             music.note.Rest: one rest in music21 format
         """
         def return_default_multirest() -> MultiRest:
-            logging.info(f'Unknown multi rest label: {multirest}, returning default Multirest.')
+            logging.info('Unknown multi rest label: %s, returning default Multirest.', multirest)
             return MultiRest()
 
         if not multirest:
@@ -156,7 +147,7 @@ class Symbol:
             music.note.Note: one note in music21 format
         """
         def return_default_note() -> music.note.Note:
-            logging.info(f'Unknown note label: {note}, returning default note.')
+            logging.info('Unknown note label: %s, returning default note.', note)
             return Note(music.duration.Duration(1), 'C4', gracenote=gracenote)
 
         if not note:
@@ -164,7 +155,7 @@ class Symbol:
 
         note, fermata = Symbol.check_fermata(note)
 
-        note_height, note_length = re.split('_', note, maxsplit=1)
+        note_height, _, note_length = note.partition('_')
 
         if not note_length or not note_height:
             return_default_note()
@@ -172,6 +163,11 @@ class Symbol:
         return Note(label_to_length(note_length),
                     note_height, fermata=fermata, gracenote=gracenote)
 
+    @staticmethod
+    def gracenote_to_symbol(note) -> Note:
+        """Converts one grace note label to internal note format."""
+        return Symbol.note_to_symbol(note, gracenote=True)
+
     @staticmethod
     def rest_to_symbol(rest) -> music.note.Rest:
         """Converts one rest label to music21 format.
@@ -183,7 +179,7 @@ class Symbol:
             music.note.Rest: one rest in music21 format
         """
         if not rest:
-            logging.info(f'Unknown rest label: {rest}, returning default rest.')
+            logging.info('Unknown rest label: %s, returning default rest.', rest)
             return music.note.Rest()
 
         rest, fermata = Symbol.check_fermata(rest)
@@ -198,8 +194,8 @@ class Symbol:
         return rest
 
     @staticmethod
-    def tie_to_symbol(label):
-        return Tie
+    def tie_to_symbol(label) -> Tie:
+        return TIE
 
     @staticmethod
     def timesignature_to_symbol(timesignature) -> music.meter.TimeSignature:
@@ -212,7 +208,7 @@ class Symbol:
             music.meter.TimeSignature: one time signature in music21 format
         """
         if not timesignature:
-            logging.info(f'Unknown time signature label: {timesignature}, returning default time signature.')
+            logging.info('Unknown time signature label: %s, returning default time signature.', timesignature)
             return music.meter.TimeSignature()
 
         if timesignature == 'C/':
@@ -240,6 +236,18 @@ class Symbol:
         return label, fermata
 
 
+# Symbol type and converter of a label by its prefix
+LABEL_PREFIX_TO_SYMBOL = {
+    'clef': (SymbolType.CLEF, Symbol.clef_to_symbol),
+    'gracenote': (SymbolType.GRACENOTE, Symbol.gracenote_to_symbol),
+    'keySignature': (SymbolType.KEY_SIGNATURE, Symbol.keysignature_to_symbol),
+    'multirest': (SymbolType.MULTI_REST, Symbol.multirest_to_symbol),
+    'note': (SymbolType.NOTE, Symbol.note_to_symbol),
+    'rest': (SymbolType.REST, Symbol.rest_to_symbol),
+    'timeSignature': (SymbolType.TIME_SIGNATURE, Symbol.timesignature_to_symbol),
+}
+
+
 class Note:
     """Represents one note in a label group.
 
@@ -247,6 +255,7 @@ class Note:
     of current measure. This class is used as an internal representation of a note before knowing its real height.
     Real height is then stored directly in `self.note` as music.note.Note object.
     """
+    __slots__ = ('duration', 'height', 'fermata', 'note', 'gracenote', 'note_ready')
 
     def __init__(self, duration: music.duration.Duration, height: str,
                  fermata: music.expressions.Fermata = None, gracenote: bool = False):
@@ -261,25 +270,24 @@ class Note:
         """Returns the real height of the note.
 
         Args:
-            key signature of current measure
+            altered_pitches: accidentals of altered pitches in current measure (by step letter)
         Returns:
              Final music.note.Note object representing the real height and other info.
         """
         if self.note_ready:
             return self.note
 
-        # pitches = [pitch.name[0] for pitch in key.alteredPitches]
-
-        if not self.height[1:-1]:
+        step, accidental, octave = self.height[0], self.height[1:-1], self.height[-1]
+        if not accidental:
             # Note has no accidental on its own and takes accidental of the altered pitches.
-            note_str = self.height[0] + altered_pitches[self.height[0]] + self.height[-1]
-            self.note = music.note.Note(note_str, duration=self.duration)
+            note_str = step + altered_pitches[step] + octave
         else:
             # Note has accidental which directly tells real note height.
-            note_str = self.height[0] + self.height[1:-1].replace('b', '-') + self.height[-1]
-            self.note = music.note.Note(note_str, duration=self.duration)
+            accidental = accidental.replace('b', '-')
+            note_str = step + accidental + octave
             # Note sets new altered pitch for future notes.
-            altered_pitches[self.height[0]] = note_str[1:-1]
+            altered_pitches[step] = accidental
+        self.note = music.note.Note(note_str, duration=self.duration)
 
         if self.gracenote:
             self.note = self.note.getGrace()
@@ -292,6 +300,7 @@ class Note:
 
 class MultiRest:
     """Represents one multi rest in a label group."""
+    __slots__ = ('duration',)
 
     def __init__(self, duration: int = 0):
         self.duration = duration
@@ -299,17 +308,19 @@ class MultiRest:
 
 class Tie:
     """Represents one tie in a label group."""
+    __slots__ = ()
 
     def __str__(self):
         return 'tie'
 
 
+TIE = Tie()  # Tie has no state, all tie symbols share one instance
+
+
 class AlteredPitches:
     def __init__(self, key: music.key.Key):
         self.key = key
-        self.alteredPitches = {}
-        for pitch in self.key.alteredPitches:
-            self.alteredPitches[pitch.name[0]] = pitch.name[1]
+        self.alteredPitches = {pitch.name[0]: pitch.name[1] for pitch in self.key.alteredPitches}
 
     def __repr__(self):
         return str(self.alteredPitches)
@@ -319,9 +330,7 @@ class AlteredPitches:
 
     def __getitem__(self, pitch_name: str):
         """Gets name of pitch (e.g. 'C', 'G', ...) and returns its alternation."""
-        if pitch_name not in self.alteredPitches:
-            return ''
-        return self.alteredPitches[pitch_name]
+        return self.alteredPitches.get(pitch_name, '')
 
     def __setitem__(self, pitch_name: str, direction: str):
         """Sets item.
@@ -389,8 +398,10 @@ def label_to_length(length: str) -> music.duration.Duration:
     Returns:
         music.duration.Duration: one duration in music21 format
     """
-    if length in SYMBOL_TO_LENGTH:
-        return music.duration.Duration(SYMBOL_TO_LENGTH[length])
-    else:
-        logging.info(f'Unknown duration label: {length}, returning default duration.')
+    quarter_length = SYMBOL_TO_LENGTH.get(length)
+    if quarter_length is None:
+        logging.info('Unknown duration label: %s, returning default duration.', length)
         return music.duration.Duration(1)
+
+    # New duration every time, music21 links duration to the note or rest it is given to
+    return music.duration.Duration(quarter_length)